@@ -24,10 +24,21 @@
   - Recommendation: use a fresh ingest alias per episode to isolate invoices
 """
 
+import atexit
+import copy
+import hashlib
 import logging
-from datetime import datetime, timezone
-
-from flask import Flask, jsonify, request
+import logging.handlers
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import orjson
+from cachetools import TTLCache
+from flask import Flask, Response, jsonify, request
+from flask.json.provider import JSONProvider
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
 import json
 import os
 
@@ -36,7 +47,8 @@ from config import (
     EVENT_TYPE,
     DEMO_CUSTOMER_ALIAS,
     BILLABLE_METRIC_NAME,
-    BILLABLE_GROUP_KEYS,
+    BILLABLE_GROUP_KEYS_LIST,
+    PRICING_GROUP_KEY,
     BILLABLE_PRICES,
     PRODUCT_NAME,
     RATE_CARD_NAME,
@@ -46,10 +58,59 @@ from config import (
 from services.metronome_client import MetronomeClient
 
 
-logging.basicConfig(level=logging.INFO)
+# Route log records through an unbounded queue: handlers enqueue in O(1)
+# and a background listener does the actual stream I/O, so request threads
+# never block on logging's handler lock.
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue, logging.StreamHandler(), respect_handler_level=True
+)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 logger = logging.getLogger(__name__)
 
+class ORJSONProvider(JSONProvider):
+    """Back Flask's jsonify/get_json with orjson.
+
+    orjson encodes straight to bytes in native code, several times faster
+    than stdlib json. OPT_UTC_Z also emits datetimes as RFC3339 with a
+    trailing Z — the format Metronome expects — so response payloads can
+    carry datetime objects directly.
+    """
+
+    def dumps(self, obj, **_):
+        return orjson.dumps(obj, option=orjson.OPT_UTC_Z).decode()
+
+    def loads(self, s, **_):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = ORJSONProvider(app)
+
+# Hard cap on request bodies; Werkzeug rejects larger payloads before we
+# read them. /api/generate additionally enforces a tighter 4KB limit.
+app.config["MAX_CONTENT_LENGTH"] = 16 * 1024
+
+# Shed excess load before any JSON parsing or SDK work: clients are keyed
+# by X-Client-Id when present (falling back to remote address) and get a
+# 429 instead of burning Metronome quota during a retry storm.
+limiter = Limiter(
+    key_func=lambda: request.headers.get("X-Client-Id") or get_remote_address(),
+    app=app,
+    storage_uri="memory://",
+    default_limits=["100/second"],
+)
+
+
+@app.errorhandler(429)
+def _rate_limited(e):
+    resp = jsonify({"error": "Too many requests", "code": "rate_limited"})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = "1"
+    return resp
 
 if not METRONOME_BEARER_TOKEN:
     raise RuntimeError("METRONOME_BEARER_TOKEN is not set. Configure it in .env")
@@ -59,38 +120,134 @@ if not DEMO_CUSTOMER_ALIAS:
 
 client = MetronomeClient(METRONOME_BEARER_TOKEN)
 
+# Bounded pool for fanning out independent setup calls (the per-tier rates
+# in /api/pricing); bounded so a burst of setup requests can't spawn
+# unlimited threads against the Metronome API.
+_pricing_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rates")
+
+# Request-validation constants, hoisted so /api/generate doesn't rebuild
+# them per call (set/dict literals can't be constant-folded by CPython).
+_ALLOWED_TIERS = frozenset(("standard", "high-res", "ultra"))
+_ALLOWED_TIERS_SORTED = ("high-res", "standard", "ultra")
+
+# The 400 bodies below never change, so serialize them once at import
+# instead of running json.dumps per rejected request.
+_INVALID_TIER_BODY = json.dumps({
+    "error": "Invalid or missing 'tier'",
+    "allowed": list(_ALLOWED_TIERS_SORTED),
+}).encode()
+_MISSING_TX_BODY = json.dumps({
+    "error": "Missing 'transaction_id' (idempotency key). Provide a stable, unique string per action.",
+}).encode()
+
+# Idempotency short-circuit: Metronome dedupes transaction_ids server-side,
+# but a local cache of recently seen keys lets client retries skip the
+# network entirely. Entries are only added once the ingestor confirms
+# delivery, so a retry of an event that never made it upstream re-sends
+# instead of getting a replayed 200. Each entry pairs a properties
+# fingerprint with the response we returned, so a reused key with
+# different properties is rejected (409) instead of silently dropped.
+_SEEN_TRANSACTIONS = TTLCache(maxsize=100_000, ttl=3600)
+_SEEN_TRANSACTIONS_LOCK = threading.RLock()
+
+
+def _prop(data: dict, key: str, default: str) -> str:
+    """Fetch a property value, coercing to str only when it isn't one.
+
+    Well-formed clients send strings, so the common case skips the str()
+    call entirely (`type(v) is str` is cheaper than isinstance here).
+    """
+    v = data.get(key, default)
+    return v if type(v) is str else str(v)
+
+
+def _properties_fingerprint(properties: dict) -> str:
+    """Stable SHA-256 over a canonical JSON serialization of properties."""
+    canonical = json.dumps(properties, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+# Default event properties; per-request values are layered on via dict merge
+_PROPS_DEFAULT = {
+    "image_type": "",
+    "num_images": "1",
+    "model": "nova-v2",
+    "region": "us-west-2",
+}
+
 
 # ---- Local state helpers (ids only; never committed) ----
 STATE_PATH = ".metronome_config.json"
 
+# Parsed state keyed by file mtime, so repeated setup calls skip the
+# open/json.load round-trip unless the file actually changed on disk.
+_STATE_CACHE = {"mtime": 0.0, "data": None}
+
 def _load_state() -> dict:
-    """Load local IDs/state persisted between runs (if present)."""
+    """Load local IDs/state persisted between runs (if present).
+
+    Served from the in-memory cache while the file's mtime is unchanged;
+    callers get a shallow copy so top-level mutations don't leak back.
+    """
     try:
-        if os.path.exists(STATE_PATH):
-            with open(STATE_PATH, "r") as f:
-                return json.load(f)
+        st = os.stat(STATE_PATH)
+    except OSError:
+        return {}
+    if _STATE_CACHE["data"] is not None and st.st_mtime == _STATE_CACHE["mtime"]:
+        return copy.copy(_STATE_CACHE["data"])
+    try:
+        with open(STATE_PATH, "r") as f:
+            data = json.load(f)
     except Exception:
-        pass
-    return {}
+        return {}
+    _STATE_CACHE["data"] = data
+    _STATE_CACHE["mtime"] = st.st_mtime
+    return copy.copy(data)
 
 
 def _save_state(state: dict) -> None:
-    """Persist local IDs/state to disk for idempotent setup."""
+    """Persist local IDs/state to disk for idempotent setup.
+
+    Writes to a sibling temp file and swaps it in with os.replace, so a
+    crash mid-write can never leave a torn/partial state file behind.
+    """
     try:
-        with open(STATE_PATH, "w") as f:
+        tmp = STATE_PATH + ".tmp"
+        with open(tmp, "w") as f:
             json.dump(state, f, indent=2)
+        os.replace(tmp, STATE_PATH)
+        # Write-through so the next _load_state is a cache hit
+        _STATE_CACHE["data"] = state
+        _STATE_CACHE["mtime"] = os.stat(STATE_PATH).st_mtime
     except Exception:
         logger.warning("Failed to save state file %s", STATE_PATH)
 
 
-def _ensure_metric() -> dict:
+# Confirmed-metric memo shared by /api/metrics and /api/pricing. A plain
+# module slot (not lru_cache) so the defer_save flag stays out of the cache
+# key and both routes hit the same entry.
+_METRIC_CACHE = {"metric": None}
+
+
+def _ensure_metric(defer_save: bool = False) -> dict:
     """Create or reuse the Episode 4 metric and persist its ID.
 
     Simple idempotent behavior:
     - If a stored metric_id exists and is retrievable → reuse.
     - Else look up by name and reuse the first match → persist id.
     - Else create anew → persist id.
+
+    Once a metric is confirmed it's memoized in _METRIC_CACHE, so repeat
+    calls (e.g., /api/pricing after /api/metrics) return it without
+    re-hitting disk or the API.
+
+    With `defer_save=True` the metric_id is not persisted here; callers
+    that do their own _save_state at the end (setup_pricing) use this to
+    coalesce state writes into one.
     """
+    cached = _METRIC_CACHE["metric"]
+    if cached is not None:
+        return cached
+
     state = _load_state()
 
     # 1) Try stored id first
@@ -99,6 +256,7 @@ def _ensure_metric() -> dict:
         existing = client.retrieve_billable_metric(metric_id)
         if existing:
             logger.info("Using existing metric from state: %s", metric_id)
+            _METRIC_CACHE["metric"] = existing
             return existing
 
     # 2) Try to find by name (non-archived)
@@ -107,8 +265,10 @@ def _ensure_metric() -> dict:
     if matches:
         m = matches[0]
         state["metric_id"] = m.get("id")
-        _save_state(state)
+        if not defer_save:
+            _save_state(state)
         logger.info("Linked existing metric by name: %s -> %s", BILLABLE_METRIC_NAME, m.get("id"))
+        _METRIC_CACHE["metric"] = m
         return m
 
     # 3) Create a new metric
@@ -117,19 +277,22 @@ def _ensure_metric() -> dict:
         event_type=EVENT_TYPE,
         aggregation_type="SUM",
         aggregation_key="num_images",
-        group_keys=[list(x) for x in BILLABLE_GROUP_KEYS],
+        group_keys=BILLABLE_GROUP_KEYS_LIST,
         property_filters=[
             {"name": "image_type", "exists": True},
             {"name": "num_images", "exists": True},
         ],
     )
     state["metric_id"] = created.get("id")
-    _save_state(state)
+    if not defer_save:
+        _save_state(state)
     logger.info("Created metric: %s", created.get("id"))
+    _METRIC_CACHE["metric"] = created
     return created
 
 
 @app.post("/api/generate")
+@limiter.limit("50/second")
 def generate_image():
     """Accepts JSON and emits a usage event.
 
@@ -139,57 +302,97 @@ def generate_image():
         -H 'Content-Type: application/json' \
         -d '{"tier":"ultra","transaction_id":"ep3-demo-001","model":"nova-v2","region":"us-west-2"}'
     """
-    data = request.get_json(silent=True) or {}
+    # The endpoint only needs a few short fields; reject oversized bodies
+    # before spending CPU/memory parsing them.
+    if request.content_length and request.content_length > 4096:
+        return jsonify({"error": "payload too large"}), 413
+
+    # Don't even attempt to parse non-JSON posts
+    ct = request.headers.get("Content-Type", "")
+    if not ct.startswith("application/json"):
+        return jsonify({"error": "Content-Type must be application/json"}), 415
+
+    # cache=False: no need to keep the parsed dict on the request object
+    data = request.get_json(silent=True, cache=False)
+    if not isinstance(data, dict):
+        return jsonify({"error": "JSON body must be an object"}), 400
 
     # Always use the ingest alias from env for this episode.
     ingest_alias = DEMO_CUSTOMER_ALIAS
 
-    # Validate tier (required; concise)
-    allowed = {"standard", "high-res", "ultra"}
-    tier = (data.get("tier") or "").strip().lower()
-    if tier not in allowed:
-        return jsonify({
-            "error": "Invalid or missing 'tier'",
-            "allowed": sorted(allowed),
-        }), 400
+    # Validate tier (required). Well-formed clients already send the
+    # canonical lowercase form, so try a direct membership check before
+    # paying for strip().lower() normalization. The type check keeps
+    # unhashable values (e.g. a list) on the slow path instead of blowing
+    # up the frozenset lookup.
+    raw_tier = data.get("tier")
+    if type(raw_tier) is str and raw_tier in _ALLOWED_TIERS:
+        tier = raw_tier
+    else:
+        tier = (raw_tier or "").strip().lower()
+        if tier not in _ALLOWED_TIERS:
+            return Response(_INVALID_TIER_BODY, status=400, mimetype="application/json")
+
 
-   
 
     # Build properties as strings per Metronome guidelines
     properties = {
+        **_PROPS_DEFAULT,
         "image_type": tier,
-        "num_images": "1",
-        "model": str(data.get("model", "nova-v2")),
-        "region": str(data.get("region", "us-west-2")),
+        "model": _prop(data, "model", "nova-v2"),
+        "region": _prop(data, "region", "us-west-2"),
     }
 
   
     transaction_id = (data.get("transaction_id") or "").strip()
     if not transaction_id:
-        return jsonify({
-            "error": "Missing 'transaction_id' (idempotency key). Provide a stable, unique string per action.",
-        }), 400
+        return Response(_MISSING_TX_BODY, status=400, mimetype="application/json")
+
+    # Retry short-circuit: a transaction_id we've already accepted gets the
+    # cached response back without touching Metronome. Same key with
+    # different properties is a client bug → 409.
+    fingerprint = _properties_fingerprint(properties)
+    cache_key = (ingest_alias, transaction_id)
+    with _SEEN_TRANSACTIONS_LOCK:
+        seen = _SEEN_TRANSACTIONS.get(cache_key)
+    if seen is not None:
+        if seen["fingerprint"] != fingerprint:
+            return jsonify({
+                "error": "transaction_id already used with different properties",
+                "transaction_id": transaction_id,
+            }), 409
+        return jsonify(seen["response"])
 
-    # Always use server time (UTC) for this episode
-    timestamp = datetime.now(timezone.utc)
+    def _payload(ts: str) -> dict:
+        return {
+            "success": True,
+            "event_type": EVENT_TYPE,
+            "tier": tier,
+            "ingest_alias": ingest_alias,
+            "transaction_id": transaction_id,
+            "timestamp": ts,
+        }
+
+    def _remember(ts: str) -> None:
+        # Runs on the ingest thread once Metronome has accepted the event;
+        # only then is the cached 200 safe to replay to retries.
+        with _SEEN_TRANSACTIONS_LOCK:
+            _SEEN_TRANSACTIONS[cache_key] = {
+                "fingerprint": fingerprint,
+                "response": _payload(ts),
+            }
 
     try:
-        client.send_usage_event(
+        # Server time (UTC): the client stamps the event at enqueue time
+        timestamp = client.send_usage_event(
             customer_id=ingest_alias,
             event_type=EVENT_TYPE,
             properties=properties,
-            timestamp=timestamp,
             transaction_id=transaction_id,
+            on_delivered=_remember,
         )
         logger.info("Sent usage event | event_type=%s | tier=%s | tx=%s", EVENT_TYPE, tier, transaction_id)
-        return jsonify({
-            "success": True,
-            "event_type": EVENT_TYPE,
-            "tier": tier,
-            "ingest_alias": ingest_alias,
-            "transaction_id": transaction_id,
-            "timestamp": timestamp
-        })
+        return jsonify(_payload(timestamp))
     except Exception as e:
         logger.exception("Failed to send usage event")
         return jsonify({"error": f"Failed to send usage: {e}"}), 500
@@ -235,18 +438,17 @@ def setup_pricing():
       curl -sS -X POST http://localhost:5000/api/pricing | jq
     """
     try:
-        # Ensure we have a metric and its ID
-        metric = _ensure_metric()
+        # Ensure we have a metric and its ID; the id is persisted in the
+        # single _save_state below rather than inside _ensure_metric
+        metric = _ensure_metric(defer_save=True)
         billable_metric_id = metric.get("id")
 
         # Create product tied to this metric; enable dimensional pricing
-        # Flatten config BILLABLE_GROUP_KEYS to pricing group key list
-        pricing_group_key = [g[0] for g in BILLABLE_GROUP_KEYS]
         product = client.create_product(
             name=PRODUCT_NAME,
             billable_metric_id=billable_metric_id,
-            pricing_group_key=pricing_group_key,
-            presentation_group_key=pricing_group_key,
+            pricing_group_key=PRICING_GROUP_KEY,
+            presentation_group_key=PRICING_GROUP_KEY,
         )
         product_id = product.get("id")
         if not product_id:
@@ -258,9 +460,10 @@ def setup_pricing():
         if not rate_card_id:
             return jsonify({"error": "Failed to create rate card"}), 500
 
-        # Add one flat rate per image_type using pricing group values
-        rates = {}
-        for image_type, cents in BILLABLE_PRICES.items():
+        # Add one flat rate per image_type using pricing group values.
+        # Each rate is independent, so fan the calls out across the pool
+        # instead of paying one round-trip per tier sequentially.
+        def _one_rate(image_type, cents):
             r = client.add_flat_rate(
                 rate_card_id=rate_card_id,
                 product_id=product_id,
@@ -268,7 +471,15 @@ def setup_pricing():
                 starting_at=RATE_EFFECTIVE_AT,
                 pricing_group_values={"image_type": image_type},
             )
-            rid = r.get("id") or r.get("rate_id")
+            return image_type, r.get("id") or r.get("rate_id"), cents
+
+        futures = [
+            _pricing_pool.submit(_one_rate, image_type, cents)
+            for image_type, cents in BILLABLE_PRICES.items()
+        ]
+        rates = {}
+        for future in as_completed(futures):
+            image_type, rid, cents = future.result()
             rates[image_type] = {"id": rid, "price_cents": cents}
 
         # Persist IDs so future runs can reuse
@@ -354,5 +565,8 @@ def setup_contract():
 
 
 if __name__ == "__main__":
+    # Dev server only; serves one request at a time. Use gunicorn via
+    # wsgi.py for anything beyond local experimentation.
+    debug = os.environ.get("FLASK_ENV", "").lower() == "development"
     logger.info("Starting Metronome Demo API on http://localhost:5000")
-    app.run(debug=True, port=5000)
+    app.run(debug=debug, port=5000)
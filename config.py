@@ -25,6 +25,12 @@ BILLABLE_METRIC_NAME = "Nova Image Generation"
 # SDK shape: list-of-lists (one inner list per dimension), e.g., [["image_type"], ["region"]]
 BILLABLE_GROUP_KEYS = (("image_type",),)
 
+# Precomputed views of BILLABLE_GROUP_KEYS so callers don't rebuild them
+# per call: the SDK's list-of-lists shape, and the flattened key list used
+# as a product pricing/presentation group key.
+BILLABLE_GROUP_KEYS_LIST = [list(x) for x in BILLABLE_GROUP_KEYS]
+PRICING_GROUP_KEY = [g[0] for g in BILLABLE_GROUP_KEYS]
+
 # Flat per-image prices in cents by image_type
 BILLABLE_PRICES = {
     "standard": 2,
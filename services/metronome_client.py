@@ -12,17 +12,189 @@ Notes
 - Timestamps must be RFC3339 strings in UTC with a trailing "Z".
 """
 
+import atexit
+import logging
+import threading
+import time
+from collections import deque
 from datetime import datetime, timezone
-from typing import Dict, Optional, List
+from typing import Callable, Dict, Optional, List
 
+import httpx
 from metronome import Metronome
-from config import BILLABLE_GROUP_KEYS
+from config import BILLABLE_GROUP_KEYS_LIST
+
+
+logger = logging.getLogger(__name__)
+
+# Batch ingestion tuning: flush whenever this many events are queued, or at
+# least every FLUSH_INTERVAL seconds, whichever comes first. A failed flush
+# is retried with exponential backoff (capped at MAX_FLUSH_BACKOFF seconds)
+# up to MAX_FLUSH_RETRIES consecutive times before the batch is dropped.
+MAX_BATCH = 100
+FLUSH_INTERVAL = 0.25
+MAX_FLUSH_RETRIES = 5
+MAX_FLUSH_BACKOFF = 5.0
+
+
+def _to_rfc3339(dt: datetime) -> str:
+    """Serialize to RFC3339 (UTC, seconds, trailing Z).
+
+    Events are timestamped with `datetime.now(timezone.utc)`, so the common
+    case formats field-by-field into an f-string and skips both the
+    `astimezone` conversion and locale-aware `strftime` dispatch. Naive
+    datetimes are not supported; callers must pass tz-aware values.
+    """
+    if dt.tzinfo is timezone.utc:
+        return (
+            f"{dt.year:04d}-{dt.month:02d}-{dt.day:02d}"
+            f"T{dt.hour:02d}:{dt.minute:02d}:{dt.second:02d}Z"
+        )
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _rfc3339_from_epoch(second: int) -> str:
+    """Format an epoch second as RFC3339 UTC with trailing Z.
+
+    Used for "now" timestamps: time.time() + time.gmtime() skip the
+    datetime constructor and tzinfo machinery entirely.
+    """
+    t = time.gmtime(second)
+    return (
+        f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+        f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}Z"
+    )
+
+
+# Demo defaults for create_billable_metric, built once at import; the method
+# merges per-call overrides on top instead of reassembling the dict each time.
+_BASE_METRIC_PARAMS: Dict = {
+    "aggregation_type": "SUM",
+    "aggregation_key": "num_images",
+    "group_keys": BILLABLE_GROUP_KEYS_LIST,
+    "property_filters": [
+        {"name": "image_type", "exists": True},
+        {"name": "num_images", "exists": True},
+    ],
+}
+
+
+class _BatchIngestor:
+    """Buffers usage events in process and ships them in batches.
+
+    `/api/generate` used to pay one HTTPS round-trip per event; with the
+    buffer, the request handler only appends to an in-memory queue and a
+    daemon thread drains it with batched `usage.ingest` calls. Pending
+    events are flushed at exit so a clean shutdown loses nothing.
+
+    A batch that fails to send is put back at the head of the queue and
+    retried with exponential backoff; only after MAX_FLUSH_RETRIES
+    consecutive failures is it dropped (logged loudly). transaction_ids
+    make the re-sends safe even if Metronome accepted part of a batch.
+    """
+
+    def __init__(self, client: Metronome) -> None:
+        self._client = client
+        self._events = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._failures = 0  # consecutive failed flush attempts
+        self._thread = threading.Thread(
+            target=self._run, name="metronome-ingest", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def add(self, event: Dict, on_delivered: Optional[Callable[[str], None]] = None) -> None:
+        """Queue a single event; wakes the flush thread when a batch is full.
+
+        `on_delivered`, if given, is invoked with the event's timestamp on
+        the flush thread once Metronome has accepted the batch containing
+        the event — never for batches that are ultimately dropped.
+        """
+        with self._lock:
+            self._events.append((event, on_delivered))
+            pending = len(self._events)
+        if pending >= MAX_BATCH:
+            self._wakeup.set()
+
+    def _run(self) -> None:
+        while True:
+            # Back off while flushes are failing so retries don't hammer a
+            # struggling upstream every 250ms.
+            timeout = min(FLUSH_INTERVAL * (2 ** self._failures), MAX_FLUSH_BACKOFF)
+            self._wakeup.wait(timeout=timeout)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> None:
+        """Drain the queue, sending up to MAX_BATCH events per API call.
+
+        On failure the batch goes back to the head of the queue for the
+        next attempt; after MAX_FLUSH_RETRIES consecutive failures it is
+        dropped so a dead upstream can't grow the queue without bound.
+        """
+        while True:
+            batch: List = []
+            with self._lock:
+                while self._events and len(batch) < MAX_BATCH:
+                    batch.append(self._events.popleft())
+            if not batch:
+                return
+            try:
+                self._client.v1.usage.ingest(usage=[event for event, _ in batch])
+                self._failures = 0
+                for event, on_delivered in batch:
+                    if on_delivered is not None:
+                        try:
+                            on_delivered(event["timestamp"])
+                        except Exception:
+                            logger.exception("on_delivered callback failed")
+            except Exception:
+                self._failures += 1
+                if self._failures >= MAX_FLUSH_RETRIES:
+                    logger.exception(
+                        "Dropping batch of %d events after %d failed attempts",
+                        len(batch), self._failures,
+                    )
+                    self._failures = 0
+                    continue
+                # Requeue at the head so event order is preserved and the
+                # next flush retries this batch first.
+                with self._lock:
+                    self._events.extendleft(reversed(batch))
+                logger.exception(
+                    "Failed to ingest batch of %d events (attempt %d/%d); requeued",
+                    len(batch), self._failures, MAX_FLUSH_RETRIES,
+                )
+                return
 
 
 class MetronomeClient:
     def __init__(self, bearer_token: str) -> None:
-        """Initialize the official Metronome SDK client."""
-        self.client = Metronome(bearer_token=bearer_token)
+        """Initialize the official Metronome SDK client.
+
+        The SDK instance is shared by all threads in a worker, so give its
+        httpx transport a connection pool wide enough that concurrent
+        requests don't queue behind a single keep-alive connection.
+        """
+        self.client = Metronome(
+            bearer_token=bearer_token,
+            http_client=httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=64,
+                    max_keepalive_connections=32,
+                    keepalive_expiry=30,
+                ),
+            ),
+        )
+        self._ingestor = _BatchIngestor(self.client)
+        # Last formatted event timestamp as a (epoch_second, string) pair.
+        # Events are truncated to seconds anyway, so within a bursty second
+        # every event reuses one string instead of re-running the formatter.
+        # Stored as a single tuple so readers always see a matching pair;
+        # racing writers just recompute the identical string, no lock needed.
+        self._last_ts = (0, "")
 
     # ---- Usage ingestion (single-event convenience) ----
     def send_usage_event(
@@ -31,30 +203,38 @@ class MetronomeClient:
         customer_id: str,
         event_type: str,
         properties: Optional[Dict] = None,
-        timestamp: datetime,
+        timestamp: Optional[datetime] = None,
         transaction_id: str,
-    ) -> None:
-        """Send a single usage event.
+        on_delivered: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        """Queue a single usage event for batched delivery.
+
+        Returns the RFC3339 timestamp recorded on the event, as soon as it
+        is buffered; a background thread batches queued events into
+        `usage.ingest` calls (see _BatchIngestor). Use
+        `send_usage_event_sync` when the call must complete before
+        returning (e.g., tests).
 
         Required
         - customer_id: Metronome customer ID or attached ingest alias
         - event_type: stable event name
-        - timestamp: timezone-aware datetime for the event occurrence
         - transaction_id: unique idempotency key (enables safe retries)
 
         Optional
         - properties: dict of string values (per Metronome guidelines)
+        - timestamp: timezone-aware datetime for the event occurrence;
+          defaults to the current UTC second, formatted without building
+          a datetime at all. Pass one to inject a fixed time (tests).
+        - on_delivered: called with the event's RFC3339 timestamp (on the
+          flush thread) once Metronome has actually accepted the event;
+          use it for anything that must wait for confirmed delivery.
         """
 
-        def _to_rfc3339(dt: datetime) -> str:
-            """Serialize to RFC3339 (UTC, seconds, trailing Z).
-
-            Expects an aware datetime. If a naive datetime is supplied,
-            Python will raise when converting timezones. Callers should pass
-            `datetime.now(timezone.utc)` or otherwise ensure tz-aware values.
-            """
-            return dt.astimezone(timezone.utc).replace(microsecond=0).strftime("%Y-%m-%dT%H:%M:%SZ")
-
+        second = int(time.time()) if timestamp is None else int(timestamp.timestamp())
+        last_second, ts = self._last_ts
+        if second != last_second:
+            ts = _rfc3339_from_epoch(second) if timestamp is None else _to_rfc3339(timestamp)
+            self._last_ts = (second, ts)
 
         event = {
             # Identify the customer (ID or ingest alias)
@@ -62,15 +242,42 @@ class MetronomeClient:
             # Stable event name; metrics target this via event_type_filter
             "event_type": event_type,
             # RFC3339 UTC timestamp with trailing Z
-            "timestamp": _to_rfc3339(timestamp),
+            "timestamp": ts,
             # Idempotency key to deduplicate retries
             "transaction_id": transaction_id
         }
         if properties:
             # Forward properties as provided. Per docs, keys/values should be strings.
             event["properties"] = properties
-        
-        # Ingest a single Nova event
+
+        # Hand off to the batch ingestor; actual network I/O happens off-thread
+        self._ingestor.add(event, on_delivered)
+        return ts
+
+    def send_usage_event_sync(
+        self,
+        *,
+        customer_id: str,
+        event_type: str,
+        properties: Optional[Dict] = None,
+        timestamp: datetime,
+        transaction_id: str,
+    ) -> None:
+        """Send a single usage event immediately (no batching).
+
+        Same contract as `send_usage_event`, but blocks on the API call.
+        Kept for tests and one-off scripts where buffering is unwanted.
+        """
+
+        event = {
+            "customer_id": customer_id,
+            "event_type": event_type,
+            "timestamp": _to_rfc3339(timestamp),
+            "transaction_id": transaction_id
+        }
+        if properties:
+            event["properties"] = properties
+
         self.client.v1.usage.ingest(usage=[event])
 
     # ---- Customers ----
@@ -107,22 +314,29 @@ class MetronomeClient:
         - aggregation_key: required for numeric aggregations ("num_images" for our demo)
         - group_keys: list of lists of property names for dimensional breakdowns
                       (shape must be e.g., [["image_type"], ["region"]])
-        - property_filters: optional filters; e.g., require fields to exist
-          [{"name": "image_type", "exists": True}, {"name": "num_images", "exists": True}]
+        - property_filters: filters; defaults to requiring image_type and
+          num_images to exist (see _BASE_METRIC_PARAMS)
         """
 
+        # Merge per-call values over the precomputed demo defaults
         params: Dict = {
+            **_BASE_METRIC_PARAMS,
             "name": name,
-            "aggregation_type": aggregation_type,
             "event_type_filter": {"in_values": [event_type]},
         }
-        if aggregation_key:
-            params["aggregation_key"] = aggregation_key
-        # Use provided group_keys or fall back to immutable config default
-        keys = group_keys if group_keys is not None else BILLABLE_GROUP_KEYS
+        if aggregation_type != _BASE_METRIC_PARAMS["aggregation_type"]:
+            params["aggregation_type"] = aggregation_type
+        if aggregation_key != _BASE_METRIC_PARAMS["aggregation_key"]:
+            if aggregation_key:
+                params["aggregation_key"] = aggregation_key
+            else:
+                del params["aggregation_key"]
+        # Rebuild the mutable values so nothing downstream can mutate the
+        # shared template (or config constants) through the params dict
+        keys = group_keys if group_keys is not None else params["group_keys"]
         params["group_keys"] = [list(x) for x in keys]
-        if property_filters:
-            params["property_filters"] = property_filters
+        filters = property_filters or params["property_filters"]
+        params["property_filters"] = [dict(f) for f in filters]
 
         resp = self.client.v1.billable_metrics.create(**params)
         return resp.data.model_dump() if hasattr(resp, "data") else {}
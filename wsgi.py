@@ -0,0 +1,14 @@
+"""
+WSGI entrypoint for production servers.
+
+The Flask dev server (`python app.py`) handles one request at a time,
+which serializes every /api/generate on its outbound Metronome call.
+Point gunicorn (or any WSGI server) here instead:
+
+    gunicorn -w 4 -k gthread --threads 16 --bind 0.0.0.0:5000 wsgi:application
+
+Each worker process gets its own MetronomeClient (and batch ingestor);
+threads within a worker share them.
+"""
+
+from app import app as application